@@ -1,20 +1,28 @@
 import pandas as pd
 import numpy as np
+import sys
 import traceback
+import json
 import pytz
 import send_emails
 import datetime
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.schedulers.blocking import BlockingScheduler
+from apscheduler.jobstores.base import JobLookupError
 from pid.decorator import pidfile
 from time import sleep
-from shared import common
+from shared import common, ledger, plan
 
 
 def schedule_email_jobs(logs_dirpath, config_filepath):
     # configure logging
     logging = common.setup_logging(__file__, logs_dirpath)
 
+    # compact delivery ledger once per day, also on days without classes
+    send_ledger = ledger.SendLedger()
+    send_ledger.compact(logging)
+    send_ledger.close()
+
     # load config
     config = common.read_config(config_filepath, logging)
 
@@ -22,68 +30,249 @@ def schedule_email_jobs(logs_dirpath, config_filepath):
         logging.error('Invalid or missing config. Exiting {}...'.format(__file__))
         return
 
-    # process schedule and customer files
-    classes_today = get_classes_today(config, logging)
-    customers = get_customers(config, logging)
+    # reuse today's cached plan if its inputs are unchanged, otherwise recompute
+    fingerprints = common.get_input_fingerprints(config_filepath, config)
+    email_plan = get_email_schedule(config, fingerprints, logging)
 
-    if classes_today is None or customers is None:
+    if email_plan is None:
         logging.warning('Exiting scheduler: no emails will be scheduled today.')
         return
 
-    # get df with email schedule
-    scheduled_df = compute_email_schedule(config, classes_today, customers, logging)
+    # only schedule the unsent remainder
+    send_ledger = ledger.SendLedger()
+    sent = send_ledger.get_claimed(fingerprints['date'])
+    send_ledger.close()
+
+    email_plan = remove_sent(email_plan, sent, logging)
 
-    scheduler = common.setup_scheduler(BackgroundScheduler, 'EmailJob', logging, 'schedule_email_jobs')
+    scheduler = common.setup_scheduler(BackgroundScheduler, 'EmailJob', logging, 'schedule_email_jobs',
+                                       executor_type=common.SupervisedThreadPoolExecutor)
     scheduler.start()
-    logging.info('Scheduling {} tasks'.format(scheduled_df.shape[0]))
+    logging.info('Scheduling {} tasks'.format(len(email_plan)))
+
+    add_email_jobs(scheduler, email_plan, logs_dirpath, config_filepath, logging)
+
+    logging.info('Sleeping until jobs are added to queue...')
+    while len(scheduler.get_jobs(pending=True)) > 0:
+        sleep(1)
+
+    scheduler.shutdown()  # remove connection
+
+    logging.info('Emails successfully scheduled')
+
+
+def reschedule_changed_jobs(logs_dirpath, config_filepath):
+    # configure logging
+    logging = common.setup_logging(__file__, logs_dirpath)
+
+    # cheap check on raw inputs before validating anything. editors may briefly remove the file while saving
+    try:
+        with open(common.prepare_filepath(config_filepath)) as f:
+            raw_config = json.load(f)
+        fingerprints = common.get_input_fingerprints(config_filepath, raw_config)
+    except (json.decoder.JSONDecodeError, KeyError, TypeError, OSError):
+        logging.warning('Could not fingerprint {}. Keeping current jobs.'.format(config_filepath))
+        return
+
+    cached = common.read_cached_fingerprints(logging)
+
+    if cached is None or cached.get('date') != fingerprints['date']:
+        # the daily job has not run yet or failed on its inputs: schedule the rest of today's emails
+        logging.info('No plan for today yet, scheduling the remaining emails for today')
+    elif cached == fingerprints:
+        return
+    else:
+        logging.info('Inputs changed, rescheduling affected jobs')
+
+    # rows of the previous plan that have no stored job anymore were already dispatched
+    previous_fingerprints, previous_plan = common.read_cached_schedule(logging)
+    planned = None
+    if previous_plan is not None and previous_fingerprints.get('date') == fingerprints['date']:
+        planned = set(previous_plan.keys())
+
+    # load config
+    config = common.read_config(config_filepath, logging)
+
+    if config is None:
+        logging.error('Invalid config. Keeping current jobs.')
+        common.save_cached_fingerprints(fingerprints)  # don't retry until the inputs change again
+        return
+
+    email_plan = get_email_schedule(config, fingerprints, logging)
+
+    if email_plan is None:
+        logging.warning('No plan computed. Keeping current jobs.')
+        common.save_cached_fingerprints(fingerprints)  # don't recompute until the inputs change again
+        return
+
+    # never re-send what was already delivered
+    send_ledger = ledger.SendLedger()
+    sent = send_ledger.get_claimed(fingerprints['date'])
+    send_ledger.close()
+
+    email_plan = remove_sent(email_plan, sent, logging)
+
+    # client only: this scheduler adds and removes jobs but never runs them, so it needs no executor
+    scheduler = common.setup_scheduler(BackgroundScheduler, 'EmailJob', logging, 'reschedule_changed_jobs',
+                                       executor_type=None)
+    scheduler.start(paused=True)
+
+    to_remove, to_add = diff_email_jobs(scheduler.get_jobs(jobstore='mongodb-EmailJob'), email_plan,
+                                        logs_dirpath, config_filepath, fingerprints['date'], planned,
+                                        datetime.datetime.now(tz=pytz.timezone('Etc/GMT+5')))
+    logging.info('Removing {} and adding or updating {} jobs'.format(len(to_remove), len(to_add)))
+
+    for job in to_remove:
+        scheduler.remove_job(job.id, jobstore='mongodb-EmailJob')
+    add_email_jobs(scheduler, to_add, logs_dirpath, config_filepath, logging)
+
+    # detach the job store first: shutdown wakes the scheduler thread for one last pass over due jobs
+    scheduler.remove_jobstore('mongodb-EmailJob')
+    scheduler.shutdown()  # remove connection
+
+    logging.info('Emails successfully rescheduled')
+
+
+def diff_email_jobs(jobs, email_plan, logs_dirpath, config_filepath, date, planned, now):
+    # compare at (EmailGroup, Recipient) granularity for today's jobs
+    jobs_by_name = {j.name: j for j in jobs if j.id.endswith('::' + date)}
+
+    is_changed = []
+    names = set()
+    for row in email_plan:
+        names.add(row.name)
+        job = jobs_by_name.get(row.name)
+
+        if job is None:
+            # a planned row without a stored job was already dispatched (queued, sending, failed or misfired), even if
+            # re-batching moved it later. new rows are added even if due and left to their misfire grace time.
+            # without a previous plan, only rows still in the future are added.
+            if planned is not None:
+                is_changed.append((row.email_group, row.recipient) not in planned)
+            else:
+                is_changed.append(row.scheduled_time > now)
+        else:
+            is_changed.append(list(job.args) != row.as_args() + [logs_dirpath, config_filepath])
+
+    to_remove = [j for name, j in jobs_by_name.items() if name not in names]
+
+    return to_remove, email_plan.select(is_changed)
 
-    for _, row in scheduled_df.iterrows():
-        job = scheduler.add_job(func=send_emails.send_email,
+
+def add_email_jobs(scheduler, email_plan, logs_dirpath, config_filepath, logger):
+    for row in email_plan:
+        job = scheduler.add_job(id='::'.join([row.name, ledger.get_ledger_date(row.scheduled_time)]),
+                                func=send_emails.send_email,
                                 trigger='date',
-                                args=row.tolist() + [logs_dirpath],
+                                args=row.as_args() + [logs_dirpath, config_filepath],
                                 jobstore='mongodb-EmailJob',
                                 executor='executor-EmailJob',
-                                name='::'.join([str(c) for c in row[['EmailGroup', 'Recipient']]]),
-                                misfire_grace_time=int(row['GraceTimeSeconds']), # 100000000
+                                name=row.name,
+                                misfire_grace_time=row.grace_time_seconds, # 100000000
                                 coalesce=False,
                                 max_instances=1,
-                                next_run_time=row['ScheduledTime'],  # DEBUG datetime.now(pytz.timezone('Etc/GMT+5')) + timedelta(seconds=10),
+                                next_run_time=row.scheduled_time,  # DEBUG datetime.now(pytz.timezone('Etc/GMT+5')) + timedelta(seconds=10),
                                 replace_existing=True)
-        logging.info('Added job with ID {} expiring at {}'.format(job.id, int(row['GraceTimeSeconds'])))
+        logger.info('Added job with ID {} expiring at {}'.format(job.id, row.grace_time_seconds))
 
-    logging.info('Sleeping until jobs are added to queue...')
-    while len(scheduler.get_jobs(pending=True)) > 0:
-        sleep(1)
 
-    scheduler.shutdown()  # remove connection
+def get_email_schedule(config, fingerprints, logger):
+    email_plan, changed_body_paths = common.load_cached_schedule(fingerprints, logger)
 
-    logging.info('Emails successfully scheduled')
+    if email_plan is not None:
+        if len(changed_body_paths) > 0:
+            patch_html_bodies(email_plan, changed_body_paths, logger)
+            common.save_cached_schedule(email_plan, fingerprints, logger)
 
+        return email_plan
 
-def get_classes_today(config, logger):
-    logger.info('Loading classes and customers')
+    # resolve schedule and customer files, reusing the index until they change
+    plan_index = get_plan_index(config, fingerprints, logger)
 
-    schedule = common.read_df(config['schedule_path'], index_col=0)
-    lookup = {i: weekday for i, weekday in enumerate(common.DAYS)}
-    today = pd.Timestamp.today(tz=pytz.timezone('Etc/GMT+5')).weekday()
-    # today = 5  # DEBUG: HARDCODE SATURDAY
-    if today == 6:
-        logger.warning('No classes on Sunday')
+    if plan_index is None:
         return None
 
-    today = lookup[today]
+    # get plan with email schedule for the day the inputs were fingerprinted
+    date = datetime.datetime.strptime(fingerprints['date'], '%Y-%m-%d').date()
+    email_plan = compute_email_schedule(config, plan_index, date, logger)
 
-    classes_today = None
+    if email_plan is None:
+        return None
 
-    if today not in schedule.columns:
-        logger.warning('No classes found for today ({}). Only found for {}'
-                       .format(today, str(schedule.columns.tolist())))
-        logger.warning('0 emails will be sent.')
-    else:
-        classes_today = schedule[today].apply(str)
-        classes_today = pd.to_datetime(classes_today, errors='coerce').dropna()
+    common.save_cached_schedule(email_plan, fingerprints, logger)
+
+    return email_plan
+
+
+def get_plan_index(config, fingerprints, logger):
+    plan_index = common.load_cached_index(fingerprints, logger)
 
-    return classes_today
+    if plan_index is None:
+        plan_index = build_plan_index(config, logger)
+
+        if plan_index is not None:
+            common.save_cached_index(plan_index, fingerprints, logger)
+
+    return plan_index
+
+
+def patch_html_bodies(email_plan, changed_body_paths, logger):
+    for body_path in changed_body_paths:
+        logger.info('Reloading body from {}'.format(body_path))
+        _, html = common.read_html(body_path, bundle=True)
+        email_plan.replace_body(body_path, html)
+
+
+def remove_sent(email_plan, sent, logger):
+    if len(sent) == 0:
+        return email_plan
+
+    is_sent = [key in sent for key in email_plan.keys()]
+    logger.info('Skipping {} emails already delivered or being delivered today'.format(sum(is_sent)))
+
+    return email_plan.select([not s for s in is_sent])
+
+
+def build_plan_index(config, logger):
+    logger.info('Indexing classes and customers')
+
+    schedule = common.read_df(config['schedule_path'], index_col=0)
+    customers = get_customers(config, logger)
+
+    if customers is None:
+        return None
+
+    # parse each distinct class time once, as seconds after midnight
+    seconds = {}
+    for cell in {str(cell) for day in common.DAYS if day in schedule.columns for cell in schedule[day]}:
+        t = pd.to_datetime(cell, errors='coerce')
+        if not pd.isnull(t):
+            seconds[cell] = t.hour * 3600 + t.minute * 60 + t.second
+
+    class_times = {}
+    for day in common.DAYS:
+        if day not in schedule.columns:
+            logger.warning('No classes found for {}. Only found for {}'.format(day, str(schedule.columns.tolist())))
+            continue
+
+        class_times[day] = {schedule_name: seconds[str(cell)] for schedule_name, cell in schedule[day].items()
+                            if str(cell) in seconds}
+
+    # get all recipients for each email group (CASE-SENSITIVE), don't send duplicate emails: a recipient of several
+    # email groups sharing a schedule_name only gets the first group's email
+    lower_programs = customers.Program.str.lower()
+    seen = {}
+    recipients = []
+    for email_group in config['email_groups']:
+        lower_recipients = [recip.lower() for recip in email_group['kicksite_recipients']]
+        seen_by_schedule = seen.setdefault(email_group['schedule_name'], set())
+        group_recipients = [sys.intern(r) for r in
+                            customers.Email[lower_programs.isin(lower_recipients)].drop_duplicates()
+                            if r not in seen_by_schedule]
+        seen_by_schedule.update(group_recipients)
+        recipients.append(group_recipients)
+
+    return plan.PlanIndex(common.DAYS, config['email_groups'], class_times, recipients)
 
 
 def get_customers(config, logger):
@@ -106,127 +295,97 @@ def get_customers(config, logger):
     return customers
 
 
-def compute_email_schedule(config, classes_today, customers, logger):
-    logger.info('Computing email schedule')
-
-    # create df and define types
-    schedule_df = pd.DataFrame(columns=['EmailGroup', 'Recipient', 'SubjectTitle', 'HtmlBody', 'ScheduledTime',
-                                        'ClassTime', 'GraceTimeSeconds'])
-    schedule_df.EmailGroup = schedule_df.EmailGroup.astype(str)
-    schedule_df.Recipient = schedule_df.Recipient.astype(str)
-    schedule_df.SubjectTitle = schedule_df.SubjectTitle.astype(str)
-    schedule_df.HtmlBody = schedule_df.HtmlBody.astype(str)
-    schedule_df.ScheduledTime = pd.to_datetime(schedule_df.ScheduledTime)
-    schedule_df.ClassTime = pd.to_datetime(schedule_df.ClassTime)
-    schedule_df.GraceTimeSeconds = schedule_df.GraceTimeSeconds.astype(int)
-
-    # create df for each recipient in an email group
-    for email_group in config['email_groups']:
-
-        # get all recipients for this email group (CASE-SENSITIVE)
-        lower_recipients = [recip.lower() for recip in email_group['kicksite_recipients']]
-        recipients = customers[customers.Program.str.lower().isin(lower_recipients)]
-
-        # read HTML
-        _, html = common.read_html(email_group['body_path'])
+def compute_email_schedule(config, plan_index, date, logger):
+    logger.info('Computing email schedule for {}'.format(date))
 
-        # create new df for this group and concat
-        eg_df = pd.DataFrame(data={'EmailGroup': [email_group['schedule_name']] * recipients.shape[0],
-                                   'Recipient': recipients.Email,
-                                   'SubjectTitle': [email_group['subject_title']] * recipients.shape[0],
-                                   'HtmlBody': [html] * recipients.shape[0]})
+    class_times = plan_index.get_class_times(date)
 
-        schedule_df = pd.concat((schedule_df, eg_df), sort=False)
+    if class_times is None:
+        logger.warning('No classes on {}'.format(date.strftime('%A')))
+        return None
 
-    schedule_df.reset_index(inplace=True, drop=True)
+    email_plan = plan.EmailPlan()
 
     # get scheduling configuration
     batch_size = config['batch_size']
-    batch_wait_time_sec = config['batch_wait_time_sec']
+    batch_wait_time_sec = int(config['batch_wait_time_sec'].total_seconds())
 
     # split into morning_and_noon and afternoon by class time
-    today_at_noon = np.datetime64(str(np.datetime64('today')) + 'T12:00')
-    morning_and_noon_classes = classes_today[classes_today <= today_at_noon].index.tolist()
-    afternoon_classes = classes_today[classes_today > today_at_noon].index.tolist()
-
-    morning_and_noon_scheduled_df = schedule_df[schedule_df.EmailGroup.isin(morning_and_noon_classes)]
-    afternoon_scheduled_df = schedule_df[schedule_df.EmailGroup.isin(afternoon_classes)]
-
-    if morning_and_noon_scheduled_df.shape[0] > 0:
-        morning_and_noon_scheduled_df.ClassTime = \
-            morning_and_noon_scheduled_df.EmailGroup.apply(lambda x: classes_today[x]).dt.tz_localize('Etc/GMT+5')
-        morning_and_noon_scheduled_df = schedule_subset_time(morning_and_noon_scheduled_df,
-                                                             config['start_send_time_map']['morning_and_noon'],
-                                                             batch_size,
-                                                             batch_wait_time_sec,
-                                                             logger)
-    if afternoon_scheduled_df.shape[0] > 0:
-        afternoon_scheduled_df.ClassTime = \
-            afternoon_scheduled_df.EmailGroup.apply(lambda x: classes_today[x]).dt.tz_localize('Etc/GMT+5')
-        afternoon_scheduled_df = schedule_subset_time(afternoon_scheduled_df,
-                                                      config['start_send_time_map']['afternoon'],
-                                                      batch_size,
-                                                      batch_wait_time_sec,
-                                                      logger)
-
+    noon = int(datetime.datetime(date.year, date.month, date.day, hour=12,
+                                 tzinfo=pytz.timezone('Etc/GMT+5')).timestamp())
+    morning_and_noon_classes = [name for name, class_time in class_times.items() if class_time <= noon]
+    afternoon_classes = [name for name, class_time in class_times.items() if class_time > noon]
 
     # schedule the emails
-    schedule_df = pd.concat((morning_and_noon_scheduled_df, afternoon_scheduled_df))
-
-    return schedule_df
-
-
-def schedule_subset_time(subset_df, start_datetime, batch_size, wait_time, logger):
-    scheduled_emails_df = pd.DataFrame()
-    current_datetime = start_datetime.astimezone(pytz.timezone('Etc/GMT+5'))
+    for classes, start_time_key in ((morning_and_noon_classes, 'morning_and_noon'),
+                                    (afternoon_classes, 'afternoon')):
+        start_time = config['start_send_time_map'][start_time_key]
+        start_datetime = datetime.datetime(date.year, date.month, date.day, hour=start_time.hour,
+                                           minute=start_time.minute, tzinfo=pytz.timezone('Etc/GMT+5'))
+        selected = [i for i, eg in enumerate(plan_index.email_groups) if eg['schedule_name'] in classes]
+        schedule_subset_time(email_plan,
+                             [plan_index.email_groups[i] for i in selected],
+                             class_times,
+                             [plan_index.recipients[i] for i in selected],
+                             start_datetime,
+                             batch_size,
+                             batch_wait_time_sec,
+                             logger)
+
+    return email_plan
+
+
+def schedule_subset_time(email_plan, email_groups, class_times, recipients_by_group, start_datetime, batch_size,
+                         wait_time_sec, logger):
+    current_time = int(start_datetime.timestamp())
+
+    # email groups sharing a schedule_name are sent as one run of batches, each with its own subject and body
+    by_schedule_name = {}
+    for email_group, recipients in zip(email_groups, recipients_by_group):
+        by_schedule_name.setdefault(email_group['schedule_name'], []).append((email_group, recipients))
 
     # process each email group
-    for email_group in subset_df.EmailGroup.unique():
-
-        schedule_by_email_group = subset_df[subset_df.EmailGroup == email_group].copy()
-
-        # don't send duplicate emails
-        schedule_by_email_group.drop_duplicates(subset=['Recipient', 'EmailGroup'], inplace=True)
+    for schedule_name, parts in by_schedule_name.items():
+        n_recipients = sum(len(recipients) for _, recipients in parts)
 
-        logger.info("email_group '{}' has {} recipients".format(email_group,
-                                                                schedule_by_email_group.shape[0]))
+        logger.info("email_group '{}' has {} recipients".format(schedule_name, n_recipients))
 
-        idx = 0
+        if n_recipients == 0:
+            continue
 
         # process each batch within an email group
-        while idx < schedule_by_email_group.shape[0]:
+        n_batches = -(-n_recipients // batch_size)
+        scheduled_times = current_time + (np.arange(n_recipients) // batch_size) * wait_time_sec
 
-            # get current batch
-            start = idx
-            end = min(start + batch_size, schedule_by_email_group.shape[0])
-            size = end - start
+        logger.info('Preparing {} in {} batches to send from {}'
+                    .format(schedule_name, n_batches,
+                            datetime.datetime.fromtimestamp(current_time, tz=pytz.timezone('Etc/GMT+5'))))
 
-            # schedule current batch
-            logger.info('Preparing {} [{}:{}/{}] to send at {}'
-                        .format(email_group, start, end, schedule_by_email_group.shape[0], current_datetime))
+        # at least 30 minutes before class time (if already passed, then set to grace time of 1 to fail)
+        class_time = class_times[schedule_name]
+        grace_times = np.maximum(1, class_time - scheduled_times - 30 * 60)
 
-            batch_idx = schedule_by_email_group.iloc[start:end].index
-            schedule_by_email_group.loc[batch_idx, 'ScheduledTime'] = [current_datetime] * size
+        start = 0
+        for email_group, recipients in parts:
+            end = start + len(recipients)
 
-            # move to next batch and datetime
-            idx += batch_size
-            current_datetime += wait_time
+            if len(recipients) > 0:
+                # read HTML
+                _, html = common.read_html(email_group['body_path'], bundle=True)
 
-        scheduled_emails_df = pd.concat((scheduled_emails_df, schedule_by_email_group))
+                email_plan.add_group(schedule_name, email_group['subject_title'], email_group['body_path'], html,
+                                     recipients, scheduled_times[start:end], class_time, grace_times[start:end])
 
-    # at least 30 minutes before class time (if already passed, then set to grace time of 1 to fail)
-    for idx in scheduled_emails_df.index:
-        ct = scheduled_emails_df.loc[idx, 'ClassTime'].to_pydatetime().astimezone(pytz.timezone('Etc/GMT+5'))
-        st = scheduled_emails_df.loc[idx, 'ScheduledTime'].astimezone(pytz.timezone('Etc/GMT+5'))
-        scheduled_emails_df.loc[idx, 'GraceTimeSeconds'] = max(1, int((ct - st).total_seconds()) - 30 * 60)
+            start = end
 
-    return scheduled_emails_df
+        # move to next batch and datetime
+        current_time += n_batches * wait_time_sec
 
 
 @pidfile()  # only run one instance of this script at a time
 def main():
     # get command line args
-    args = common.handle_argparse()
+    args = common.handle_argparse(watch_interval_sec=True)
 
     # configure logging
     logging = common.setup_logging(__file__, args.logs_dirpath)
@@ -252,8 +411,29 @@ def main():
                              replace_existing=True)                        # replace if already exists in DB
     # schedule_email_jobs(args.logs_dirpath, args.config_filepath)  # DEBUG
 
+    # optionally pick up intraday changes to config, customers, schedule and templates
+    if args.watch_interval_sec is not None:
+        config_scheduler.add_job(id='watch_job',
+                                 func=reschedule_changed_jobs,
+                                 args=[args.logs_dirpath, args.config_filepath],
+                                 jobstore='mongodb-CronJob',
+                                 executor='executor-CronJob',
+                                 name='Intraday rescheduler',
+                                 trigger='interval',
+                                 seconds=args.watch_interval_sec,
+                                 coalesce=True,
+                                 max_instances=1,
+                                 replace_existing=True)
+    else:
+        try:
+            config_scheduler.remove_job('watch_job', jobstore='mongodb-CronJob')
+        except JobLookupError:
+            pass
+
     # configure scheduler for EmailJob, if they exist - allow processing of emails
-    email_scheduler = common.setup_scheduler(BlockingScheduler, 'EmailJob', logging, 'main')
+    email_scheduler = common.setup_scheduler(BlockingScheduler, 'EmailJob', logging, 'main',
+                                             executor_type=common.SupervisedThreadPoolExecutor)
+    common.poll_jobstores(email_scheduler)  # pick up jobs added by the daily and watch jobs
     email_scheduler.start()  # blocking call, will not exit
 
 
@@ -1,29 +1,39 @@
 import smtplib
+import traceback
+from time import monotonic
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from shared import common
+from shared import common, ledger, senders, assets
 
 
 FROM = 'USERNAME'
 PW = 'PASSWORD'
+SMTP_TIMEOUT_SEC = 60  # below the executor's heartbeat timeout, so a stalled connection fails the send
 
 
-def email(to, subject, html_body):
-    # create email
-    msg = MIMEMultipart()
-    msg['From'] = FROM
+def email(to, subject, html_body, account=None):
+    if account is None:
+        account = dict(senders.DEFAULT_ACCOUNT, username=FROM, password=PW)
+
+    # create email, with bundled template images attached by reference
+    html_body, asset_parts = assets.get_asset_parts(html_body)
+    msg = MIMEMultipart('related') if len(asset_parts) > 0 else MIMEMultipart()
+    msg['From'] = account['username']
     msg['Subject'] = subject
     msg.attach(MIMEText(html_body, 'html'))
 
     # send the message via our SMTP server
-    smtp_server = smtplib.SMTP_SSL("smtp.gmail.com", 465)
-    smtp_server.login(FROM, PW)
+    smtp_type = smtplib.SMTP_SSL if account['use_ssl'] else smtplib.SMTP
+    smtp_server = smtp_type(account['host'], account['port'], timeout=SMTP_TIMEOUT_SEC)
+    if account.get('password'):
+        smtp_server.login(account['username'], account['password'])
 
-    smtp_server.sendmail(FROM, to, msg.as_string())
+    smtp_server.sendmail(account['username'], to, assets.flatten_with_asset_parts(msg, asset_parts))
     smtp_server.quit()
 
 
-def send_email(schedule_name, recipient, subject_title, html_body, scheduled_time, class_time, grace_time, logs_dirpath):
+def send_email(schedule_name, recipient, subject_title, html_body, scheduled_time, class_time, grace_time, logs_dirpath,
+               config_filepath=None):
     # configure logging
     logging = common.setup_logging(__file__, logs_dirpath)
 
@@ -32,11 +42,55 @@ def send_email(schedule_name, recipient, subject_title, html_body, scheduled_tim
                        str(scheduled_time), str(class_time), str(grace_time)])
     logging.info(key)
 
+    # claim before sending, skip if already delivered or being delivered (e.g. after a restarted pool or host,
+    # or by another scheduler on the same job store)
+    send_ledger = ledger.get_process_ledger()
+    date = ledger.get_ledger_date(scheduled_time)
+
+    if not send_ledger.claim(date, schedule_name, recipient):
+        logging.warning('Already delivered or being delivered, skipping {}'.format(key))
+        return
+
+    # pick a sender account by remaining quota and latency, sticky per email group. the claim is taken, so any
+    # error here must release it as failed instead of leaving it 'sending'
+    try:
+        sender_pool = senders.get_process_sender_pool(config_filepath) if config_filepath is not None else None
+        account = sender_pool.choose(date, schedule_name) if sender_pool is not None else None
+    except Exception as e:
+        logging.error('Could not pick a sender account for {} with exception: {}'.format(key, traceback.format_exc()))
+        record_outcome(send_ledger, date, schedule_name, recipient, ledger.STATUS_FAILED, key, logging, str(e))
+        return
+
+    if sender_pool is not None:
+        if account is None:
+            logging.error('All sender accounts exhausted their daily quota. Could not deliver {}'.format(key))
+            record_outcome(send_ledger, date, schedule_name, recipient, ledger.STATUS_FAILED, key, logging,
+                           'quota exhausted')
+            return
+
+    start = monotonic()
     try:
-        email([recipient], subject_title, html_body)
-    except:
+        email([recipient], subject_title, html_body, account)
+    except Exception as e:
         logging.error('Could not deliver {}'.format(key))
+        record_outcome(send_ledger, date, schedule_name, recipient, ledger.STATUS_FAILED, key, logging, str(e))
+        success = False
         # TODO: reschedule?
+    else:
+        record_outcome(send_ledger, date, schedule_name, recipient, ledger.STATUS_SENT, key, logging)
+        success = True
+
+    if account is not None:
+        sender_pool.record(date, account, monotonic() - start, success=success)
+
+
+def record_outcome(send_ledger, date, schedule_name, recipient, status, key, logger, detail=None):
+    # a ledger error must not fail the job; an unrecorded claim stays 'sending', so the email is never re-sent
+    try:
+        send_ledger.record(date, schedule_name, recipient, status, detail)
+    except Exception:
+        logger.error('Could not record {} as {} in the send ledger with exception: {}'
+                     .format(key, status, traceback.format_exc()))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,145 @@
+import os
+import re
+import hashlib
+import struct
+import threading
+import uuid
+from bs4 import BeautifulSoup
+from email.mime.image import MIMEImage
+from . import common
+
+
+CID_DOMAIN = 'jma-sender'
+CID_PATTERN = re.compile(r'cid:([0-9a-f]{40})@' + re.escape(CID_DOMAIN))
+ORIGINAL_SRC_ATTR = 'data-jma-src'
+IMAGE_EXTENSIONS = {'.png': 'png', '.jpg': 'jpeg', '.jpeg': 'jpeg', '.gif': 'gif'}
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_METADATA_CHUNKS = {b'tEXt', b'zTXt', b'iTXt', b'tIME', b'eXIf'}
+
+_asset_parts = {}
+_asset_parts_lock = threading.Lock()
+
+
+def get_cid(content_hash):
+    return '{}@{}'.format(content_hash, CID_DOMAIN)
+
+
+def optimize_png(data):
+    # lossless: drop metadata chunks that clients never render
+    if not data.startswith(PNG_SIGNATURE):
+        return data
+
+    optimized = [PNG_SIGNATURE]
+    idx = len(PNG_SIGNATURE)
+    while idx + 8 <= len(data):
+        length, chunk_type = struct.unpack('>I4s', data[idx:idx + 8])
+        end = idx + 12 + length
+        if chunk_type not in PNG_METADATA_CHUNKS:
+            optimized.append(data[idx:end])
+        idx = end
+
+    return b''.join(optimized)
+
+
+def bundle_asset(filepath):
+    # store the optimized image once in the cache, keyed by content hash
+    with open(filepath, 'rb') as f:
+        data = f.read()
+
+    ext = os.path.splitext(filepath)[1].lower()
+    if ext == '.png':
+        data = optimize_png(data)
+
+    content_hash = hashlib.sha1(data).hexdigest()
+    asset_path = os.path.join(common.get_cache_assets_path(), content_hash + ext)
+
+    if not os.path.exists(asset_path):
+        os.makedirs(os.path.dirname(asset_path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(asset_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, asset_path)
+
+    return content_hash
+
+
+def bundle_assets(soup, base_dirpath):
+    # rewrite local <img> sources to cid: references. remote URLs are left untouched.
+    for img in soup.find_all('img', src=True):
+        src = img['src']
+        if re.match(r'^[a-zA-Z][a-zA-Z0-9+.-]*:', src):
+            continue
+
+        filepath = os.path.normpath(os.path.join(base_dirpath, src))
+        if os.path.splitext(filepath)[1].lower() not in IMAGE_EXTENSIONS or not os.path.isfile(filepath):
+            continue
+
+        img[ORIGINAL_SRC_ATTR] = src
+        img['src'] = 'cid:' + get_cid(bundle_asset(filepath))
+
+
+def get_asset_parts(html_body):
+    # returns (html_body, parts). parts are encoded and serialized once per process and shared by every message that
+    # references them. assets missing from this host's cache fall back to their original src.
+    parts = []
+    missing = set()
+
+    for content_hash in sorted(set(CID_PATTERN.findall(html_body))):
+        with _asset_parts_lock:
+            if content_hash not in _asset_parts:
+                part = _load_asset_part(content_hash)
+                if part is None:
+                    missing.add(content_hash)
+                    continue
+                _asset_parts[content_hash] = part.as_string()
+
+        parts.append(_asset_parts[content_hash])
+
+    if len(missing) > 0:
+        html_body = _restore_original_src(html_body, missing)
+
+    return html_body, parts
+
+
+def flatten_with_asset_parts(msg, asset_parts):
+    # splice the serialized parts into the flattened message instead of re-generating them for every message
+    if len(asset_parts) == 0:
+        return msg.as_string()
+
+    boundary = '=' * 15 + uuid.uuid4().hex + '=='
+    msg.set_boundary(boundary)
+
+    flattened = msg.as_string()
+    idx = flattened.rindex('\n--{}--'.format(boundary))
+
+    return flattened[:idx] + ''.join('\n--{}\n{}'.format(boundary, part) for part in asset_parts) + flattened[idx:]
+
+
+def _restore_original_src(html_body, missing):
+    soup = BeautifulSoup(html_body, 'html.parser')
+
+    for img in soup.find_all('img', src=True):
+        match = CID_PATTERN.fullmatch(img['src'])
+        if match is not None and match.group(1) in missing and img.has_attr(ORIGINAL_SRC_ATTR):
+            img['src'] = img[ORIGINAL_SRC_ATTR]
+
+    return str(soup)
+
+
+def _load_asset_part(content_hash):
+    # None if the asset is not in the cache (cleared, or bundled on another host)
+    assets_dirpath = common.get_cache_assets_path()
+    filenames = [f for f in os.listdir(assets_dirpath) if os.path.splitext(f)[0] == content_hash] \
+        if os.path.isdir(assets_dirpath) else []
+
+    if len(filenames) == 0:
+        return None
+
+    with open(os.path.join(assets_dirpath, filenames[0]), 'rb') as f:
+        data = f.read()
+
+    part = MIMEImage(data, IMAGE_EXTENSIONS[os.path.splitext(filenames[0])[1].lower()])
+    part.add_header('Content-ID', '<{}>'.format(get_cid(content_hash)))
+    part.add_header('Content-Disposition', 'inline', filename=filenames[0])
+
+    return part
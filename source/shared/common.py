@@ -6,29 +6,42 @@ import logging
 import sys
 import argparse
 import shutil
+import hashlib
+import gzip
+import pickle
 import pytz
 import threading
-from time import sleep
+import queue
+from time import sleep, monotonic
 from datetime import datetime, timedelta
 from bs4 import BeautifulSoup
+from apscheduler.executors.base import BaseExecutor, run_job
 from apscheduler.executors.pool import ProcessPoolExecutor
 from apscheduler.jobstores.mongodb import MongoDBJobStore
 from concurrent.futures.process import BrokenProcessPool
-from . import validate
+from . import validate, assets
 
 
 DAYS = ['M', 'T', 'W', 'Th', 'F', 'Sa']
 LOG_FILENAME = 'jma_sender.log'
-SCHEDULED_EMAILS_FILENAME = 'scheduled.csv'
+SCHEDULED_EMAILS_FILENAME = 'scheduled.pkl'
 CACHED_CONFIG_FILENAME = 'cached_config.json'
+CACHED_INDEX_FILENAME = 'plan_index.pkl'
+CACHED_INDEX_VERSION = 2  # bump when PlanIndex changes
+JOBSTORE_POLL_INTERVAL_SEC = 2
 
+_logging_lock = threading.Lock()
 
-def handle_argparse(config_filepath=True, logs_dirpath=True):
+
+def handle_argparse(config_filepath=True, logs_dirpath=True, watch_interval_sec=False):
     parser = argparse.ArgumentParser(description='Schedule emails to be sent today.')
     if config_filepath:
         parser.add_argument('--config_filepath', type=str, help='/path/to/config.json')
     if logs_dirpath:
         parser.add_argument('--logs_dirpath', type=str, help='/path/to/logs')
+    if watch_interval_sec:
+        parser.add_argument('--watch_interval_sec', type=int, default=None,
+                            help='reschedule changed jobs when inputs change, checking every N seconds')
 
     return parser.parse_args()
 
@@ -38,15 +51,19 @@ def setup_logging(calling_filename, log_dirpath=None, level=logging.DEBUG):
     root_logger = logging.getLogger()
     root_logger.setLevel(level)
 
-    if log_dirpath is not None:
-        file_handler = logging.FileHandler(os.path.normpath(os.path.join(log_dirpath,
-                                                                         LOG_FILENAME)))
-        file_handler.setFormatter(log_formatter)
-        root_logger.addHandler(file_handler)
+    # jobs call this on every run; only attach each handler once per process
+    with _logging_lock:
+        if log_dirpath is not None:
+            log_filepath = os.path.abspath(os.path.join(log_dirpath, LOG_FILENAME))
+            if not any(getattr(h, 'baseFilename', None) == log_filepath for h in root_logger.handlers):
+                file_handler = logging.FileHandler(log_filepath)
+                file_handler.setFormatter(log_formatter)
+                root_logger.addHandler(file_handler)
 
-    console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setFormatter(log_formatter)
-    root_logger.addHandler(console_handler)
+        if not any(getattr(h, 'stream', None) is sys.stdout for h in root_logger.handlers):
+            console_handler = logging.StreamHandler(sys.stdout)
+            console_handler.setFormatter(log_formatter)
+            root_logger.addHandler(console_handler)
 
     logging.info('{} launched at {}'.format(calling_filename, str(pd.Timestamp.now(pytz.timezone('Etc/GMT+5')))))
 
@@ -148,6 +165,151 @@ def get_cache_config_path():
     return os.path.join(get_cache_path(), 'cache', CACHED_CONFIG_FILENAME)
 
 
+def get_cache_index_path():
+    return os.path.join(get_cache_path(), 'cache', CACHED_INDEX_FILENAME)
+
+
+def get_cache_assets_path():
+    return os.path.join(get_cache_path(), 'cache', 'assets')
+
+
+def fingerprint_file(filepath):
+    sha1 = hashlib.sha1()
+    with open(os.path.normpath(filepath), 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+def get_input_fingerprints(config_filepath, config):
+    # the plan is only valid for the day it was computed
+    today = datetime.now(tz=pytz.timezone('Etc/GMT+5'))
+
+    return {
+        'date': today.strftime('%Y-%m-%d'),
+        'config': fingerprint_file(config_filepath),
+        'customers': fingerprint_file(config['customers_path']),
+        'schedule': fingerprint_file(config['schedule_path']),
+        'templates': {os.path.normpath(eg['body_path']): fingerprint_file(eg['body_path'])
+                      for eg in config['email_groups']}
+    }
+
+
+def read_cached_fingerprints(logger):
+    fingerprints_path = get_cache_config_path()
+
+    if not os.path.exists(fingerprints_path):
+        return None
+
+    with open(fingerprints_path) as f:
+        try:
+            return json.load(f)
+        except json.decoder.JSONDecodeError:
+            logger.warning('Cached fingerprints at {} are corrupt'.format(fingerprints_path))
+            return None
+
+
+def replace_file(filepath, dump, opener=open, mode='w'):
+    # write a temporary file and rename it over filepath, so readers never see a partial or mixed write
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(filepath, os.getpid())
+
+    with opener(tmp_path, mode) as f:
+        dump(f)
+    os.replace(tmp_path, filepath)
+
+
+def save_cached_schedule(email_plan, fingerprints, logger):
+    # the plan is stored with the fingerprints it was computed from; the separate fingerprints file is only a cheap
+    # change check for watch mode and is written last
+    schedule_path = get_cache_schedule_path()
+
+    logger.info('Caching schedule of {} emails to {}'.format(len(email_plan), schedule_path))
+    replace_file(schedule_path,
+                 lambda f: pickle.dump((fingerprints, email_plan), f, protocol=pickle.HIGHEST_PROTOCOL),
+                 opener=gzip.open, mode='wb')
+
+    save_cached_fingerprints(fingerprints)
+
+
+def save_cached_fingerprints(fingerprints):
+    replace_file(get_cache_config_path(), lambda f: json.dump(fingerprints, f, indent=2))
+
+
+def read_cached_schedule(logger):
+    # (fingerprints, email_plan) as last cached, whether or not they are still current
+    schedule_path = get_cache_schedule_path()
+
+    if not os.path.exists(schedule_path):
+        logger.info('No cached schedule found')
+        return None, None
+
+    try:
+        with gzip.open(schedule_path, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        logger.warning('Could not read cached schedule at {}'.format(schedule_path))
+        return None, None
+
+
+def load_cached_schedule(fingerprints, logger):
+    # returns (email_plan, changed_body_paths), or (None, None) if the plan must be recomputed
+    cached, email_plan = read_cached_schedule(logger)
+
+    if email_plan is None:
+        return None, None
+
+    stale = [k for k in ('date', 'config', 'customers', 'schedule') if cached.get(k) != fingerprints[k]]
+    if len(stale) > 0:
+        logger.info('Cached schedule is stale ({} changed)'.format(', '.join(stale)))
+        return None, None
+
+    # template edits only change the bodies and can be patched in place
+    cached_templates = cached.get('templates', {})
+    changed_body_paths = [path for path, fp in fingerprints['templates'].items() if cached_templates.get(path) != fp]
+
+    logger.info('Loaded cached schedule of {} emails ({} templates changed)'
+                .format(len(email_plan), len(changed_body_paths)))
+
+    return email_plan, changed_body_paths
+
+
+def get_index_key(fingerprints):
+    # the plan index does not depend on the date or the email bodies
+    return [CACHED_INDEX_VERSION, fingerprints['config'], fingerprints['customers'], fingerprints['schedule']]
+
+
+def save_cached_index(plan_index, fingerprints, logger):
+    index_path = get_cache_index_path()
+
+    logger.info('Caching plan index to {}'.format(index_path))
+    replace_file(index_path,
+                 lambda f: pickle.dump((get_index_key(fingerprints), plan_index), f, protocol=pickle.HIGHEST_PROTOCOL),
+                 opener=gzip.open, mode='wb')
+
+
+def load_cached_index(fingerprints, logger):
+    index_path = get_cache_index_path()
+
+    if not os.path.exists(index_path):
+        logger.info('No cached plan index found')
+        return None
+
+    try:
+        with gzip.open(index_path, 'rb') as f:
+            key, plan_index = pickle.load(f)
+    except Exception:
+        logger.warning('Could not read cached plan index at {}'.format(index_path))
+        return None
+
+    if key != get_index_key(fingerprints):
+        logger.info('Cached plan index is stale')
+        return None
+
+    return plan_index
+
+
 def read_df(filepath, index_col=None):
     df = None
 
@@ -192,12 +354,16 @@ def explode_str(df, col, sep):
     return df
 
 
-def read_html(filepath):
+def read_html(filepath, bundle=False):
     with open(os.path.normpath(filepath), 'r') as f:
         lines = [line.rstrip() for line in f]
 
     soup = BeautifulSoup(''.join(lines), "html.parser").find()
 
+    # embed local images once as cid: attachments shared by every message. off for validation, which must not write
+    if soup is not None and bundle:
+        assets.bundle_assets(soup, os.path.dirname(os.path.normpath(filepath)))
+
     return bool(soup), soup.prettify() if soup is not None else None
 
 
@@ -227,7 +393,134 @@ class FixedPoolExecutor(ProcessPoolExecutor):
         return super()._do_submit_job(job, run_times)
 
 
-def setup_scheduler(scheduler_type, job_type, logger, debug=''):
+class SupervisedThreadPoolExecutor(BaseExecutor):
+    # I/O-bound jobs (sending) run on threads. a supervisor thread replaces dead or hung workers one at a time, so
+    # submitting a job never blocks or waits on a pool restart.
+
+    def __init__(self, max_workers=20, heartbeat_timeout_sec=300, supervise_interval_sec=5):
+        super().__init__()
+        self._max_workers = max_workers
+        self._heartbeat_timeout_sec = heartbeat_timeout_sec
+        self._supervise_interval_sec = supervise_interval_sec
+        self._queue = queue.Queue()
+        self._workers = []
+        self._workers_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._worker_count = 0
+        self._supervisor = None
+        self._alias = None
+
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+        self._alias = alias
+
+        with self._workers_lock:
+            for _ in range(self._max_workers):
+                self._spawn_worker()
+
+        self._supervisor = threading.Thread(target=self._supervise, name='{}-supervisor'.format(alias),
+                                            daemon=True)
+        self._supervisor.start()
+
+    def shutdown(self, wait=True):
+        self._stopped.set()
+
+        with self._workers_lock:
+            workers = list(self._workers)
+
+        for _ in workers:
+            self._queue.put(None)
+
+        if wait:
+            for worker in workers:
+                worker.thread.join()
+
+    def _do_submit_job(self, job, run_times):
+        self._queue.put_nowait((job, run_times))
+
+    def _spawn_worker(self):
+        # caller holds _workers_lock
+        self._worker_count += 1
+        worker = _Worker()
+        worker.thread = threading.Thread(target=self._work, args=(worker,),
+                                         name='{}-worker-{}'.format(self._alias, self._worker_count), daemon=True)
+        self._workers.append(worker)
+        worker.thread.start()
+
+    def _work(self, worker):
+        while not self._stopped.is_set() and not worker.retired:
+            worker.busy = False
+            worker.heartbeat = monotonic()
+
+            try:
+                item = self._queue.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            if item is None:
+                break
+
+            job, run_times = item
+            worker.busy = True
+            worker.heartbeat = monotonic()
+
+            try:
+                events = run_job(job, job._jobstore_alias, run_times, self._logger.name)
+            except BaseException as e:
+                # the worker dies with its job; the supervisor replaces it
+                self._run_job_error(job.id, e, e.__traceback__)
+                raise
+            else:
+                self._run_job_success(job.id, events)
+
+    def _supervise(self):
+        while not self._stopped.wait(self._supervise_interval_sec):
+            now = monotonic()
+
+            with self._workers_lock:
+                for worker in list(self._workers):
+                    if not worker.thread.is_alive():
+                        self._logger.warning('Worker {} died. Replacing it.'.format(worker.thread.name))
+                        self._workers.remove(worker)
+                        self._spawn_worker()
+                    elif worker.busy and not worker.retired and \
+                            now - worker.heartbeat > self._heartbeat_timeout_sec:
+                        # threads cannot be killed: retire it after its current job and start a replacement
+                        self._logger.warning('Worker {} is hung for {:.0f} sec. Replacing it.'
+                                             .format(worker.thread.name, now - worker.heartbeat))
+                        worker.retired = True
+                        self._workers.remove(worker)
+                        self._spawn_worker()
+
+
+class _Worker:
+    __slots__ = ('thread', 'busy', 'heartbeat', 'retired')
+
+    def __init__(self):
+        self.thread = None
+        self.busy = False
+        self.heartbeat = monotonic()
+        self.retired = False
+
+
+def poll_jobstores(scheduler, interval_sec=JOBSTORE_POLL_INTERVAL_SEC):
+    # a scheduler only re-reads its job stores when it wakes up, and jobs added by another process (daily job, watch
+    # job) don't wake it. a no-op job in memory wakes it at least every interval_sec.
+    scheduler.add_job(id='poll_jobstores',
+                      func=_wake,
+                      trigger='interval',
+                      seconds=interval_sec,
+                      name='Job store poll',
+                      coalesce=True,
+                      max_instances=1,
+                      replace_existing=True)
+
+
+def _wake():
+    pass
+
+
+def setup_scheduler(scheduler_type, job_type, logger, debug='', executor_type=FixedPoolExecutor):
     logger.info('Creating {} scheduler for {} jobs [{}-{}]'.format(scheduler_type, job_type, debug,
                                                                    threading.current_thread().ident))
 
@@ -235,8 +528,10 @@ def setup_scheduler(scheduler_type, job_type, logger, debug=''):
     scheduler.add_jobstore(alias='mongodb-{}'.format(job_type),
                            jobstore=MongoDBJobStore(database='EmailSchedule', collection=job_type))
 
-    scheduler.add_executor(alias='executor-{}'.format(job_type),
-                           executor=FixedPoolExecutor(max_workers=20))
+    # executor_type=None for clients that only add or remove jobs
+    if executor_type is not None:
+        scheduler.add_executor(alias='executor-{}'.format(job_type),
+                               executor=executor_type(max_workers=20))
     scheduler.timezone = pytz.timezone('Etc/GMT+5')
 
     return scheduler
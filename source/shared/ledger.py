@@ -0,0 +1,98 @@
+import os
+import pytz
+import threading
+from datetime import datetime, timedelta
+from pymongo import MongoClient, ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+
+LEDGER_DATABASE = 'EmailSchedule'
+LEDGER_COLLECTION = 'SendLedger'
+STATUS_SENDING = 'sending'
+STATUS_SENT = 'sent'
+STATUS_FAILED = 'failed'
+
+_process_ledger = None
+_process_ledger_lock = threading.Lock()
+
+
+def get_ledger_date(dt=None):
+    if dt is None:
+        dt = datetime.now(tz=pytz.timezone('Etc/GMT+5'))
+
+    return dt.astimezone(pytz.timezone('Etc/GMT+5')).strftime('%Y-%m-%d')
+
+
+class SendLedger:
+
+    def __init__(self, client=None, database=LEDGER_DATABASE, collection=LEDGER_COLLECTION):
+        self.client = client if client is not None else MongoClient()
+        self.collection = self.client[database][collection]
+        self.pid = os.getpid()
+
+        # one entry per (Date, EmailGroup, Recipient): the unique index is what makes a claim exclusive
+        self.collection.create_index([('Date', ASCENDING),
+                                      ('EmailGroup', ASCENDING),
+                                      ('Recipient', ASCENDING)],
+                                     unique=True,
+                                     name='date_group_recipient')
+
+    def claim(self, date, email_group, recipient):
+        # returns False if the email is already sent or being sent by another worker or scheduler.
+        # a failed entry can be claimed again; a claim left 'sending' by a crash is never retried.
+        try:
+            self.collection.update_one({'Date': date,
+                                        'EmailGroup': email_group,
+                                        'Recipient': recipient,
+                                        'Status': STATUS_FAILED},
+                                       {'$set': {'Status': STATUS_SENDING,
+                                                 'Detail': None,
+                                                 'RecordedAt': datetime.now(tz=pytz.utc)}},
+                                       upsert=True)
+        except DuplicateKeyError:
+            return False
+
+        return True
+
+    def get_claimed(self, date):
+        # set of (EmailGroup, Recipient) sent or being sent on date
+        entries = self.collection.find({'Date': date, 'Status': {'$in': [STATUS_SENDING, STATUS_SENT]}},
+                                       projection={'_id': False, 'EmailGroup': True, 'Recipient': True})
+
+        return {(e['EmailGroup'], e['Recipient']) for e in entries}
+
+    def record(self, date, email_group, recipient, status, detail=None):
+        # move the claim to its outcome
+        self.collection.update_one({'Date': date,
+                                    'EmailGroup': email_group,
+                                    'Recipient': recipient},
+                                   {'$set': {'Status': status,
+                                             'Detail': detail,
+                                             'RecordedAt': datetime.now(tz=pytz.utc)}},
+                                   upsert=True)
+
+    def compact(self, logger, keep_days=7):
+        today = datetime.now(tz=pytz.timezone('Etc/GMT+5'))
+        cutoff = get_ledger_date(today - timedelta(days=keep_days))
+
+        # drop days past retention and failures from previous days (they are never retried)
+        expired = self.collection.delete_many({'Date': {'$lt': cutoff}})
+        stale_failures = self.collection.delete_many({'Date': {'$lt': get_ledger_date(today)},
+                                                      'Status': STATUS_FAILED})
+
+        logger.info('Compacted send ledger: removed {} expired and {} stale failure entries'
+                    .format(expired.deleted_count, stale_failures.deleted_count))
+
+    def close(self):
+        self.client.close()
+
+
+def get_process_ledger():
+    # one connection per worker process, shared by its threads; MongoClient is not fork-safe
+    global _process_ledger
+
+    with _process_ledger_lock:
+        if _process_ledger is None or _process_ledger.pid != os.getpid():
+            _process_ledger = SendLedger()
+
+        return _process_ledger
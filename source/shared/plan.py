@@ -0,0 +1,162 @@
+import sys
+import numpy as np
+import pytz
+from datetime import datetime
+
+
+class EmailPlanRow:
+    __slots__ = ('email_group', 'recipient', 'subject_title', 'html_body', 'scheduled_time', 'class_time',
+                 'grace_time_seconds')
+
+    def __init__(self, email_group, recipient, subject_title, html_body, scheduled_time, class_time,
+                 grace_time_seconds):
+        self.email_group = email_group
+        self.recipient = recipient
+        self.subject_title = subject_title
+        self.html_body = html_body
+        self.scheduled_time = scheduled_time
+        self.class_time = class_time
+        self.grace_time_seconds = grace_time_seconds
+
+    @property
+    def name(self):
+        return '::'.join([self.email_group, self.recipient])
+
+    def as_args(self):
+        # positional arguments of send_emails.send_email
+        return [self.email_group, self.recipient, self.subject_title, self.html_body, self.scheduled_time,
+                self.class_time, self.grace_time_seconds]
+
+
+class EmailPlan:
+    # array-backed plan, one row per (email group, recipient). strings shared by many rows are stored once in a
+    # table and referenced by code, recipients are interned and times are epoch seconds.
+
+    def __init__(self):
+        self.groups = []
+        self.subjects = []
+        self.body_keys = []
+        self.bodies = []
+
+        self.group_codes = np.empty(0, dtype=np.int16)
+        self.subject_codes = np.empty(0, dtype=np.int16)
+        self.body_ids = np.empty(0, dtype=np.int16)
+        self.recipients = np.empty(0, dtype=object)
+        self.scheduled_times = np.empty(0, dtype=np.int64)
+        self.class_times = np.empty(0, dtype=np.int64)
+        self.grace_times = np.empty(0, dtype=np.int32)
+
+    def __len__(self):
+        return self.recipients.shape[0]
+
+    def __iter__(self):
+        # rows in a batch share their times, so convert each distinct epoch once
+        tz = pytz.timezone('Etc/GMT+5')
+        datetimes = {}
+        for t in np.unique(np.concatenate((self.scheduled_times, self.class_times))).tolist():
+            datetimes[t] = datetime.fromtimestamp(t, tz=tz)
+
+        for group_code, recipient, subject_code, body_id, scheduled_time, class_time, grace_time in \
+                zip(self.group_codes.tolist(), self.recipients, self.subject_codes.tolist(), self.body_ids.tolist(),
+                    self.scheduled_times.tolist(), self.class_times.tolist(), self.grace_times.tolist()):
+            yield EmailPlanRow(self.groups[group_code],
+                               recipient,
+                               self.subjects[subject_code],
+                               self.bodies[body_id],
+                               datetimes[scheduled_time],
+                               datetimes[class_time],
+                               grace_time)
+
+    def keys(self):
+        # (EmailGroup, Recipient) of every row
+        return zip((self.groups[c] for c in self.group_codes), self.recipients)
+
+    def add_group(self, email_group, subject_title, body_key, html_body, recipients, scheduled_times, class_time,
+                  grace_times):
+        n = len(recipients)
+
+        self.group_codes = np.concatenate((self.group_codes,
+                                           np.full(n, _get_code(self.groups, email_group), dtype=np.int16)))
+        self.subject_codes = np.concatenate((self.subject_codes,
+                                             np.full(n, _get_code(self.subjects, subject_title), dtype=np.int16)))
+        self.body_ids = np.concatenate((self.body_ids,
+                                        np.full(n, self._get_body_id(body_key, html_body), dtype=np.int16)))
+
+        interned = np.empty(n, dtype=object)
+        interned[:] = [sys.intern(r) for r in recipients]
+        self.recipients = np.concatenate((self.recipients, interned))
+
+        self.scheduled_times = np.concatenate((self.scheduled_times, np.asarray(scheduled_times, dtype=np.int64)))
+        self.class_times = np.concatenate((self.class_times, np.full(n, class_time, dtype=np.int64)))
+        self.grace_times = np.concatenate((self.grace_times, np.asarray(grace_times, dtype=np.int32)))
+
+    def replace_body(self, body_key, html_body):
+        if body_key in self.body_keys:
+            self.bodies[self.body_keys.index(body_key)] = html_body
+
+    def select(self, mask):
+        mask = np.asarray(mask, dtype=bool)
+
+        subset = EmailPlan()
+        subset.groups = self.groups
+        subset.subjects = self.subjects
+        subset.body_keys = self.body_keys
+        subset.bodies = self.bodies
+
+        subset.group_codes = self.group_codes[mask]
+        subset.subject_codes = self.subject_codes[mask]
+        subset.body_ids = self.body_ids[mask]
+        subset.recipients = self.recipients[mask]
+        subset.scheduled_times = self.scheduled_times[mask]
+        subset.class_times = self.class_times[mask]
+        subset.grace_times = self.grace_times[mask]
+
+        return subset
+
+    def _get_body_id(self, body_key, html_body):
+        if body_key not in self.body_keys:
+            self.body_keys.append(body_key)
+            self.bodies.append(html_body)
+
+        return self.body_keys.index(body_key)
+
+    def __setstate__(self, state):
+        # recipients must be re-interned after unpickling
+        self.__dict__.update(state)
+        self.recipients[:] = [sys.intern(r) for r in self.recipients]
+
+
+def _get_code(table, value):
+    if value not in table:
+        table.append(value)
+
+    return table.index(value)
+
+
+class PlanIndex:
+    # everything the daily plan needs from the config, schedule and customers, resolved once per input change:
+    # email groups, class times per weekday and deduplicated recipients per email group (in the same order)
+
+    def __init__(self, weekdays, email_groups, class_times, recipients):
+        self.weekdays = weekdays
+        self.email_groups = email_groups
+        self.class_times = class_times
+        self.recipients = recipients
+
+    def get_class_times(self, date):
+        # epoch seconds of each class on date, or None if no classes are held that weekday
+        if date.weekday() >= len(self.weekdays):
+            return None
+
+        day = self.weekdays[date.weekday()]
+        if day not in self.class_times:
+            return None
+
+        midnight = int(datetime(date.year, date.month, date.day, tzinfo=pytz.timezone('Etc/GMT+5')).timestamp())
+
+        return {schedule_name: midnight + seconds for schedule_name, seconds in self.class_times[day].items()}
+
+    def __setstate__(self, state):
+        # recipients must be re-interned after unpickling
+        self.__dict__.update(state)
+        self.recipients = [[sys.intern(r) for r in recipients] for recipients in self.recipients]
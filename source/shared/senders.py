@@ -0,0 +1,166 @@
+import os
+import json
+import pytz
+import threading
+from datetime import datetime
+from pymongo import MongoClient, ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from . import validate
+
+
+SENDERS_DATABASE = 'EmailSchedule'
+USAGE_COLLECTION = 'SenderUsage'
+AFFINITY_COLLECTION = 'SenderAffinity'
+DEFAULT_ACCOUNT = {
+    'host': 'smtp.gmail.com',
+    'port': 465,
+    'use_ssl': True,
+    'daily_quota': 500
+}
+
+_process_pool = None
+_process_client = None
+_process_pool_lock = threading.Lock()
+
+
+def read_sender_accounts(config_filepath):
+    # only the sender_accounts section, so workers don't re-validate the spreadsheets on every send
+    with open(os.path.normpath(config_filepath)) as f:
+        accounts = json.load(f).get('sender_accounts')
+
+    if accounts is None:
+        return None
+
+    is_valid, errors = validate.validate_sender_accounts(accounts)
+    if not is_valid:
+        raise ValueError('Invalid sender_accounts in {}: {}'.format(config_filepath, errors))
+
+    return [dict(DEFAULT_ACCOUNT, **account) for account in accounts]
+
+
+class SenderPool:
+
+    def __init__(self, accounts, client=None, database=SENDERS_DATABASE):
+        self.accounts = {account['username']: account for account in accounts}
+        self.client = client if client is not None else MongoClient()
+        self.usage = self.client[database][USAGE_COLLECTION]
+        self.affinity = self.client[database][AFFINITY_COLLECTION]
+
+        self.usage.create_index([('Date', ASCENDING), ('Account', ASCENDING)], unique=True, name='date_account')
+        self.affinity.create_index([('EmailGroup', ASCENDING)], unique=True, name='email_group')
+
+    def choose(self, date, email_group):
+        # returns the account to send with, with one send reserved against its quota, or None if every account has
+        # used its quota for date. the reservation is released by record() if the send fails.
+        exhausted = set()
+
+        while True:
+            account = self._pick(date, email_group, exhausted)
+            if account is None or self._reserve(date, account):
+                return account
+
+            # another worker took the last of this account's quota
+            exhausted.add(account['username'])
+
+    def _pick(self, date, email_group, exhausted):
+        usage = {u['Account']: u for u in self.usage.find({'Date': date, 'Account': {'$in': list(self.accounts)}})}
+        available = {name: account for name, account in self.accounts.items()
+                     if name not in exhausted and self._remaining(account, usage.get(name)) > 0}
+
+        if len(available) == 0:
+            return None
+
+        # stick to the group's account so replies stay in one mailbox
+        sticky = self.affinity.find_one({'EmailGroup': email_group})
+        if sticky is not None and sticky['Account'] in available:
+            return available[sticky['Account']]
+
+        best = max(available.values(), key=lambda a: self._score(a, usage.get(a['username'])))
+
+        if sticky is None or sticky['Account'] not in self.accounts:
+            # spread groups over accounts when assigning a new affinity
+            assigned = {name: self.affinity.count_documents({'Account': name}) for name in available}
+            owner = max(available.values(),
+                        key=lambda a: self._score(a, usage.get(a['username'])) / (1 + assigned[a['username']]))
+
+            # first assignment wins if several workers race; overflow past quota does not move the affinity
+            if sticky is None:
+                sticky = self.affinity.find_one_and_update({'EmailGroup': email_group},
+                                                           {'$setOnInsert': {'Account': owner['username']}},
+                                                           upsert=True,
+                                                           return_document=ReturnDocument.AFTER)
+            else:
+                # account was removed from the config
+                sticky = self.affinity.find_one_and_update({'EmailGroup': email_group,
+                                                            'Account': sticky['Account']},
+                                                           {'$set': {'Account': owner['username']}},
+                                                           return_document=ReturnDocument.AFTER) or \
+                         self.affinity.find_one({'EmailGroup': email_group})
+
+        if sticky is not None and sticky['Account'] in available:
+            return available[sticky['Account']]
+
+        return best
+
+    def _reserve(self, date, account):
+        # atomic check-and-increment: matches only while under quota, otherwise the upsert hits the unique index
+        try:
+            self.usage.update_one({'Date': date,
+                                   'Account': account['username'],
+                                   'Sent': {'$lt': account['daily_quota']}},
+                                  {'$inc': {'Sent': 1},
+                                   '$set': {'UpdatedAt': datetime.now(tz=pytz.utc)}},
+                                  upsert=True)
+        except DuplicateKeyError:
+            return False
+
+        return True
+
+    def record(self, date, account, latency_sec, success=True):
+        # Sent counts reservations, so a failed send gives its reservation back
+        self.usage.update_one({'Date': date, 'Account': account['username']},
+                              {'$inc': {'Sent': 0 if success else -1,
+                                        'Attempts': 1,
+                                        'Failed': 0 if success else 1,
+                                        'LatencySecTotal': latency_sec},
+                               '$set': {'UpdatedAt': datetime.now(tz=pytz.utc)}},
+                              upsert=True)
+
+    @staticmethod
+    def _remaining(account, usage):
+        sent = usage['Sent'] if usage is not None else 0
+        return account['daily_quota'] - sent
+
+    @staticmethod
+    def _score(account, usage):
+        # prefer remaining quota, discounted by mean latency and failure rate
+        remaining = SenderPool._remaining(account, usage)
+        if usage is None or usage.get('Attempts', 0) == 0:
+            return remaining
+
+        mean_latency = usage['LatencySecTotal'] / usage['Attempts']
+        failure_rate = usage['Failed'] / usage['Attempts']
+
+        return remaining * (1 - failure_rate) / (1 + mean_latency)
+
+    def close(self):
+        self.client.close()
+
+
+def get_process_sender_pool(config_filepath):
+    # one pool per worker process, rebuilt when the config file changes. rebuilt pools share the process' connection,
+    # so nothing leaks and sends still using the previous pool are unaffected. MongoClient is not fork-safe.
+    global _process_pool, _process_client
+
+    mtime = os.path.getmtime(config_filepath)
+    key = (os.getpid(), os.path.abspath(config_filepath), mtime)
+
+    with _process_pool_lock:
+        if _process_pool is None or _process_pool[0] != key:
+            if _process_client is None or _process_client[0] != os.getpid():
+                _process_client = (os.getpid(), MongoClient())
+
+            accounts = read_sender_accounts(config_filepath)
+            _process_pool = (key, SenderPool(accounts, client=_process_client[1]) if accounts is not None else None)
+
+        return _process_pool[1]
@@ -60,6 +60,40 @@ def validate_path_and_html(field, value, error):
         error(field, 'is invalid HTML. use https://www.freeformatter.com/html-validator.html to validate your html')
 
 
+def validate_unique_usernames(field, value, error):
+    usernames = [account.get('username') for account in value if isinstance(account, dict)]
+    duplicates = sorted({u for u in usernames if usernames.count(u) > 1})
+
+    if len(duplicates) > 0:
+        error(field, 'duplicate sender account usernames: {}'.format(duplicates))
+
+
+def get_sender_accounts_schema():
+    return {
+        'type': 'list',
+        'minlength': 1,
+        'check_with': validate_unique_usernames,
+        'schema': {
+            'type': 'dict',
+            'schema': {
+                'username': {'type': 'string', 'required': True, 'empty': False},
+                'password': {'type': 'string', 'nullable': True},
+                'host': {'type': 'string', 'empty': False},
+                'port': {'type': 'integer', 'min': 1, 'max': 65535},
+                'use_ssl': {'type': 'boolean'},
+                'daily_quota': {'type': 'integer', 'min': 1}
+            }
+        }
+    }
+
+
+def validate_sender_accounts(accounts):
+    v = Validator({'sender_accounts': get_sender_accounts_schema()})
+    is_valid = v.validate({'sender_accounts': accounts})
+
+    return is_valid, v.errors
+
+
 def validate_email_groups_with_schedule_and_customers(config):
     errors = []
 
@@ -138,6 +172,7 @@ def validate_config(config):
         },
         "batch_wait_time_sec": valid_non_negative_integer,
         "batch_size": valid_nonzero_integer,
+        "sender_accounts": get_sender_accounts_schema(),
         "email_groups": {
             'type': 'list',
             "schema": {
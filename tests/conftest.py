@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the scripts in source/ import the shared package directly
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'source'))
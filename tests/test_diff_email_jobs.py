@@ -0,0 +1,68 @@
+import datetime
+import pytest
+import pytz
+from types import SimpleNamespace
+import scheduler
+from shared import plan
+
+
+TZ = pytz.timezone('Etc/GMT+5')
+DATE = '2020-06-01'
+NOW = datetime.datetime(2020, 6, 1, 12, tzinfo=TZ)
+LOGS_DIRPATH = 'logs'
+CONFIG_FILEPATH = 'config.json'
+RECIPIENTS = ['r1@example.com', 'r2@example.com', 'r3@example.com', 'r4@example.com']
+ALL = set(RECIPIENTS)
+
+
+def make_plan():
+    # r1 and r2 were due at 11:00, r3 and r4 are due at 13:00
+    email_plan = plan.EmailPlan()
+    scheduled_times = [int((NOW + datetime.timedelta(hours=h)).timestamp()) for h in (-1, -1, 1, 1)]
+    class_time = int((NOW + datetime.timedelta(hours=6)).timestamp())
+    email_plan.add_group('Kids', 'Kids class today', 'kids.html', '<p>kids</p>', RECIPIENTS, scheduled_times,
+                         class_time, [class_time - t - 30 * 60 for t in scheduled_times])
+
+    return email_plan
+
+
+def make_job(row, date=DATE, subject_title=None):
+    args = row.as_args() + [LOGS_DIRPATH, CONFIG_FILEPATH]
+    if subject_title is not None:
+        args[2] = subject_title
+
+    return SimpleNamespace(id='::'.join([row.name, date]), name=row.name, args=tuple(args))
+
+
+def removed_job(recipient):
+    return SimpleNamespace(id='::'.join(['Kids', recipient, DATE]), name='::'.join(['Kids', recipient]), args=())
+
+
+# (stored jobs by recipient: None for identical args, or a dict of changes), planned recipients, added, removed
+CASES = {
+    'unchanged': ({r: None for r in RECIPIENTS}, ALL, [], []),
+    'changed subject': ({**{r: None for r in RECIPIENTS}, 'r3@example.com': {'subject_title': 'old'}}, ALL,
+                        ['r3@example.com'], []),
+    'new recipient': ({r: None for r in RECIPIENTS if r != 'r2@example.com'}, ALL - {'r2@example.com'},
+                      ['r2@example.com'], []),
+    'removed recipient': ({r: None for r in RECIPIENTS}, ALL | {'gone@example.com'}, [], ['gone@example.com']),
+    'dispatched rows without stored jobs': ({'r4@example.com': None}, ALL, [], []),
+    'no previous plan': ({}, None, ['r3@example.com', 'r4@example.com'], []),
+    'jobs from another day': ({'r1@example.com': {'date': '2020-05-30'}}, None,
+                              ['r3@example.com', 'r4@example.com'], []),
+}
+
+
+@pytest.mark.parametrize('stored, planned, added, removed', CASES.values(), ids=list(CASES))
+def test_diff_email_jobs(stored, planned, added, removed):
+    email_plan = make_plan()
+    rows = {row.recipient: row for row in email_plan}
+
+    jobs = [make_job(rows[r], **(changes or {})) for r, changes in stored.items()]
+    jobs += [removed_job(r) for r in removed]
+    planned = {('Kids', r) for r in planned} if planned is not None else None
+
+    to_remove, to_add = scheduler.diff_email_jobs(jobs, email_plan, LOGS_DIRPATH, CONFIG_FILEPATH, DATE, planned, NOW)
+
+    assert [row.recipient for row in to_add] == added
+    assert [job.name for job in to_remove] == ['Kids::' + r for r in removed]
@@ -0,0 +1,86 @@
+import threading
+import pytz
+from time import sleep, monotonic, perf_counter
+from datetime import datetime
+from apscheduler.job import Job
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.date import DateTrigger
+from shared import common
+
+
+N_JOBS = 500
+MAX_WORKERS = 10
+CRASH_EVERY = 10    # every 10th job kills its worker thread after running
+HANG_EVERY = 100    # every 100th job outlives the heartbeat timeout
+HANG_SEC = 1.5
+HEARTBEAT_TIMEOUT_SEC = 0.5
+
+
+def test_dispatch_latency_under_worker_crashes(monkeypatch):
+    completed = set()
+    completed_lock = threading.Lock()
+
+    def work(i):
+        if i % HANG_EVERY == 1:
+            sleep(HANG_SEC)
+
+        with completed_lock:
+            completed.add(i)
+
+    # inject crashes: the worker thread dies with SystemExit after its job ran
+    run_job = common.run_job
+
+    def crashing_run_job(job, *args):
+        events = run_job(job, *args)
+        if int(job.id) % CRASH_EVERY == 0:
+            raise SystemExit('injected worker crash')
+        return events
+
+    monkeypatch.setattr(common, 'run_job', crashing_run_job)
+    monkeypatch.setattr(threading, 'excepthook', lambda args: None)
+
+    executor = common.SupervisedThreadPoolExecutor(max_workers=MAX_WORKERS,
+                                                   heartbeat_timeout_sec=HEARTBEAT_TIMEOUT_SEC,
+                                                   supervise_interval_sec=0.05)
+    scheduler = BackgroundScheduler(timezone=pytz.utc)
+    scheduler.add_executor(executor, 'io')
+    scheduler.start(paused=True)
+
+    now = datetime.now(tz=pytz.utc)
+    jobs = []
+    for i in range(N_JOBS):
+        job = Job(scheduler, id=str(i), func=work, args=(i,), kwargs={}, trigger=DateTrigger(now, pytz.utc),
+                  executor='io', max_instances=1, misfire_grace_time=None, coalesce=False, name=str(i),
+                  next_run_time=now)
+        job._jobstore_alias = 'default'
+        jobs.append(job)
+
+    try:
+        # submitting never waits on crashed or hung workers
+        latencies = []
+        for job in jobs:
+            start = perf_counter()
+            executor.submit_job(job, [now])
+            latencies.append(perf_counter() - start)
+
+        deadline = monotonic() + 10
+        while len(completed) < N_JOBS and monotonic() < deadline:
+            sleep(0.05)
+
+        # let the supervisor replace the last dead workers
+        sleep(0.2)
+
+        latencies.sort()
+        assert len(completed) == N_JOBS
+        assert latencies[int(0.99 * N_JOBS)] < 0.005
+        # a single submit may lose the GIL to a worker, but never waits out a heartbeat timeout or a hang
+        assert latencies[-1] < HEARTBEAT_TIMEOUT_SEC / 2
+
+        # each crashed and each hung worker was replaced on its own, and the pool is back to full size
+        n_crashes = N_JOBS // CRASH_EVERY
+        n_hangs = N_JOBS // HANG_EVERY
+        assert executor._worker_count >= MAX_WORKERS + n_crashes + n_hangs
+        assert len(executor._workers) == MAX_WORKERS
+        assert all(w.thread.is_alive() and not w.retired for w in executor._workers)
+    finally:
+        scheduler.shutdown(wait=False)
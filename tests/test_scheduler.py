@@ -0,0 +1,125 @@
+import os
+import json
+import logging
+import datetime
+import pandas as pd
+import pytest
+import pytz
+from time import sleep, monotonic
+import scheduler
+from shared import common
+
+
+def write_inputs(tmp_path):
+    tmp_path = str(tmp_path)
+
+    pd.DataFrame({'Emails': ['a@example.com', 'b@example.com, c@example.com', 'd@example.com', 'e@example.com'],
+                  'Programs': ['Kids TKD', 'Kids TKD, Adults TKD', 'Adults TKD', 'Adults TKD'],
+                  'Subscribed': [True, True, True, False]}) \
+        .to_csv(os.path.join(tmp_path, 'customers.csv'), index=False)
+
+    # no kids class on Saturday and no classes at all on Sunday
+    schedule = pd.DataFrame({day: ['9:00 AM', '6:30 PM'] for day in common.DAYS}, index=['Kids', 'Adults'])
+    schedule.loc['Kids', 'Sa'] = 'nan'
+    schedule.to_csv(os.path.join(tmp_path, 'schedule.csv'))
+
+    for name in ('kids', 'adults'):
+        with open(os.path.join(tmp_path, name + '.html'), 'w') as f:
+            f.write('<html><body><p>{}</p></body></html>'.format(name))
+
+    config_filepath = os.path.join(tmp_path, 'config.json')
+    with open(config_filepath, 'w') as f:
+        json.dump({'customers_path': os.path.join(tmp_path, 'customers.csv'),
+                   'schedule_path': os.path.join(tmp_path, 'schedule.csv'),
+                   'start_send_time_map': {'morning_and_noon': '08:00', 'afternoon': '12:00'},
+                   'batch_wait_time_sec': 300,
+                   'batch_size': 2,
+                   'email_groups': [{'schedule_name': 'Kids',
+                                     'kicksite_recipients': ['Kids TKD'],
+                                     'subject_title': 'Kids class today',
+                                     'body_path': os.path.join(tmp_path, 'kids.html')},
+                                    {'schedule_name': 'Adults',
+                                     'kicksite_recipients': ['Adults TKD'],
+                                     'subject_title': 'Adults class today',
+                                     'body_path': os.path.join(tmp_path, 'adults.html')}]}, f)
+
+    return config_filepath
+
+
+def test_week_is_planned_from_one_index(tmp_path):
+    logger = logging.getLogger(__name__)
+    config = common.read_config(write_inputs(tmp_path), logger)
+    plan_index = scheduler.build_plan_index(config, logger)
+
+    monday = datetime.date(2020, 6, 1)
+    week = {}
+    for i in range(7):
+        date = monday + datetime.timedelta(days=i)
+        week[date.strftime('%a')] = scheduler.compute_email_schedule(config, plan_index, date, logger)
+
+    assert week['Sun'] is None
+
+    tz = pytz.timezone('Etc/GMT+5')
+    for day, email_plan in week.items():
+        if email_plan is None:
+            continue
+
+        rows = list(email_plan)
+        date = rows[0].class_time.date()
+        groups = {row.email_group for row in rows}
+
+        assert day == date.strftime('%a')
+        assert all(row.scheduled_time.date() == date and row.scheduled_time < row.class_time for row in rows)
+        assert groups == ({'Adults'} if day == 'Sat' else {'Kids', 'Adults'})
+
+        kids = sorted(row.recipient for row in rows if row.email_group == 'Kids')
+        adults = [row for row in rows if row.email_group == 'Adults']
+        if day != 'Sat':
+            assert kids == ['a@example.com', 'b@example.com', 'c@example.com']
+        assert sorted(row.recipient for row in adults) == ['b@example.com', 'c@example.com', 'd@example.com']
+
+        # the afternoon run starts at noon and sends in batches of 2
+        assert [row.scheduled_time for row in adults] == \
+            [datetime.datetime(date.year, date.month, date.day, 12, tzinfo=tz)] * 2 + \
+            [datetime.datetime(date.year, date.month, date.day, 12, 5, tzinfo=tz)]
+        assert all(row.class_time.hour == 18 and row.class_time.minute == 30 for row in adults)
+
+
+_runs = []
+
+
+def _record_run(name):
+    _runs.append(name)
+
+
+def test_jobs_added_by_another_scheduler_are_run():
+    mongomock = pytest.importorskip('mongomock')
+    from apscheduler.jobstores.mongodb import MongoDBJobStore
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    client = mongomock.MongoClient()
+    tz = pytz.timezone('Etc/GMT+5')
+
+    # the long-lived scheduler that runs jobs, idle with an empty store
+    runner = BackgroundScheduler(timezone=tz)
+    runner.add_jobstore(MongoDBJobStore(client=client), alias='mongodb-EmailJob')
+    common.poll_jobstores(runner, interval_sec=0.2)
+    runner.start()
+
+    # a client in another process adds a job that is due before anything wakes the runner
+    adder = BackgroundScheduler(timezone=tz)
+    adder.add_jobstore(MongoDBJobStore(client=client), alias='mongodb-EmailJob')
+    adder.start(paused=True)
+    adder.add_job(_record_run, args=['added'], trigger='date', jobstore='mongodb-EmailJob', misfire_grace_time=1,
+                  run_date=datetime.datetime.now(tz=tz) + datetime.timedelta(seconds=0.5))
+    adder.remove_jobstore('mongodb-EmailJob')
+    adder.shutdown()
+
+    try:
+        deadline = monotonic() + 3
+        while 'added' not in _runs and monotonic() < deadline:
+            sleep(0.05)
+    finally:
+        runner.shutdown()
+
+    assert _runs == ['added']
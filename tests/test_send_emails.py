@@ -0,0 +1,25 @@
+import socket
+import smtplib
+import pytest
+from time import monotonic
+import send_emails
+
+
+def test_stalled_smtp_server_fails_the_send(monkeypatch):
+    # accepts the connection but never sends a greeting
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+
+    monkeypatch.setattr(send_emails, 'SMTP_TIMEOUT_SEC', 0.5)
+    account = {'username': 'sender@example.com', 'host': '127.0.0.1', 'port': server.getsockname()[1],
+               'use_ssl': False}
+
+    start = monotonic()
+    try:
+        with pytest.raises((socket.timeout, smtplib.SMTPServerDisconnected)):
+            send_emails.email(['recipient@example.com'], 'subject', '<p>body</p>', account)
+    finally:
+        server.close()
+
+    assert monotonic() - start < 5
@@ -0,0 +1,225 @@
+import os
+import json
+import socketserver
+import threading
+import pytest
+import pytz
+from time import sleep
+from datetime import datetime
+from collections import Counter
+import send_emails
+from shared import ledger, senders
+
+mongomock = pytest.importorskip('mongomock')
+
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    # minimal local SMTP server that keeps (sender, recipients) of every message
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _SmtpHandler)
+        self.messages = []
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 sink')
+        mail_from, rcpt_to = None, []
+
+        for line in iter(self.rfile.readline, b''):
+            command = line.decode().strip()
+            verb = command.upper()
+
+            if verb.startswith('MAIL FROM:'):
+                mail_from, rcpt_to = command[10:].strip(' <>'), []
+                self.reply('250 OK')
+            elif verb.startswith('RCPT TO:'):
+                rcpt_to.append(command[8:].strip(' <>'))
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                for data in iter(self.rfile.readline, b''):
+                    if data == b'.\r\n':
+                        break
+                with self.server.lock:
+                    self.server.messages.append((mail_from, rcpt_to))
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 sink')
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = mongomock.MongoClient()
+    send_ledger = ledger.SendLedger(client=client)
+
+    monkeypatch.setattr(ledger, 'get_process_ledger', lambda: send_ledger)
+    monkeypatch.setattr(senders, 'MongoClient', lambda: client)
+    monkeypatch.setattr(senders, '_process_pool', None)
+    monkeypatch.setattr(senders, '_process_client', None)
+
+    return client
+
+
+@pytest.fixture
+def sinks():
+    sinks = [SmtpSink() for _ in range(3)]
+    for sink in sinks:
+        threading.Thread(target=sink.serve_forever, daemon=True).start()
+
+    yield sinks
+
+    for sink in sinks:
+        sink.shutdown()
+        sink.server_close()
+
+
+def write_config(tmp_path, sinks, quotas):
+    config_filepath = os.path.join(str(tmp_path), 'config.json')
+    with open(config_filepath, 'w') as f:
+        json.dump({'sender_accounts': [{'username': 'sender{}@example.com'.format(i),
+                                        'host': '127.0.0.1',
+                                        'port': sink.port,
+                                        'use_ssl': False,
+                                        'daily_quota': quota}
+                                       for i, (sink, quota) in enumerate(zip(sinks, quotas))]}, f)
+
+    return config_filepath
+
+
+def test_sends_are_spread_over_local_smtp_sinks(tmp_path, client, sinks):
+    quotas = [30, 30, 30]
+    config_filepath = write_config(tmp_path, sinks, quotas)
+    now = datetime.now(tz=pytz.timezone('Etc/GMT+5'))
+    date = ledger.get_ledger_date(now)
+
+    groups = ['Group {}'.format(i % 4) for i in range(80)]
+    for i, group in enumerate(groups):
+        send_emails.send_email(group, 'student{}@example.com'.format(i), 'subject', '<p>body</p>', now, now, 1,
+                               None, config_filepath)
+
+    # every email was delivered exactly once, through an account with quota left
+    received = [rcpt for sink in sinks for _, rcpts in sink.messages for rcpt in rcpts]
+    assert sorted(received) == sorted('student{}@example.com'.format(i) for i in range(80))
+    assert all(len(sink.messages) > 0 for sink in sinks)
+    assert all(len(sink.messages) <= quota for sink, quota in zip(sinks, quotas))
+
+    # and recorded as sent in today's ledger
+    entries = client[ledger.LEDGER_DATABASE][ledger.LEDGER_COLLECTION].find({'Date': date})
+    assert sorted(e['Recipient'] for e in entries if e['Status'] == ledger.STATUS_SENT) == sorted(received)
+
+    # quota counters match what each sink received
+    usage = {u['Account']: u['Sent'] for u in client[senders.SENDERS_DATABASE][senders.USAGE_COLLECTION].find()}
+    for i, sink in enumerate(sinks):
+        assert usage['sender{}@example.com'.format(i)] == len(sink.messages)
+        assert all(mail_from == 'sender{}@example.com'.format(i) for mail_from, _ in sink.messages)
+
+    # groups stick to one account until its quota runs out
+    senders_by_group = {}
+    for i, sink in enumerate(sinks):
+        for _, rcpts in sink.messages:
+            group = groups[int(rcpts[0][len('student'):-len('@example.com')])]
+            senders_by_group.setdefault(group, Counter())[i] += 1
+    affinity = client[senders.SENDERS_DATABASE][senders.AFFINITY_COLLECTION]
+    for group, counts in senders_by_group.items():
+        owner = int(affinity.find_one({'EmailGroup': group})['Account'][len('sender'):-len('@example.com')])
+        assert counts[owner] == groups.count(group) or len(sinks[owner].messages) == quotas[owner]
+
+
+def test_quota_is_reserved_atomically(client):
+    pool = senders.SenderPool([dict(senders.DEFAULT_ACCOUNT, username='sender@example.com', daily_quota=10)],
+                              client=client)
+    chosen = []
+    lock = threading.Lock()
+
+    def choose():
+        account = pool.choose('2020-01-01', 'Group')
+        with lock:
+            chosen.append(account)
+
+    threads = [threading.Thread(target=choose) for _ in range(25)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(account is not None for account in chosen) == 10
+
+    # failed sends give their reservation back
+    account = next(account for account in chosen if account is not None)
+    for _ in range(3):
+        pool.record('2020-01-01', account, 0.1, success=False)
+
+    assert [pool.choose('2020-01-01', 'Group') is not None for _ in range(4)] == [True, True, True, False]
+
+
+def test_reloaded_pool_reuses_the_connection(tmp_path, client, sinks):
+    config_filepath = write_config(tmp_path, sinks, [10, 10, 10])
+    pool = senders.get_process_sender_pool(config_filepath)
+
+    os.utime(config_filepath, (0, 0))
+    reloaded = senders.get_process_sender_pool(config_filepath)
+
+    assert reloaded is not pool
+    assert reloaded.client is pool.client
+
+
+@pytest.mark.parametrize('content', [
+    '{"sender_accounts": [{"username": "sender@example.com", "daily_quota": "many"}]}',
+    '{"sender_accounts": [{"username": "sender@example.com", "daily_qu',
+], ids=['invalid account', 'half-written config'])
+def test_bad_sender_accounts_release_the_claim(tmp_path, client, sinks, content):
+    config_filepath = os.path.join(str(tmp_path), 'config.json')
+    with open(config_filepath, 'w') as f:
+        f.write(content)
+    now = datetime.now(tz=pytz.timezone('Etc/GMT+5'))
+
+    send_emails.send_email('Group', 'student@example.com', 'subject', '<p>body</p>', now, now, 1, None,
+                           config_filepath)
+
+    # nothing was sent and the claim was recorded as failed, not left 'sending'
+    entry = client[ledger.LEDGER_DATABASE][ledger.LEDGER_COLLECTION].find_one({'Recipient': 'student@example.com'})
+    assert entry['Status'] == ledger.STATUS_FAILED
+    assert all(len(sink.messages) == 0 for sink in sinks)
+
+
+def test_worker_threads_share_one_ledger(monkeypatch):
+    clients = []
+
+    def make_client():
+        # widen the window between the check and the assignment
+        sleep(0.01)
+        clients.append(mongomock.MongoClient())
+        return clients[-1]
+
+    monkeypatch.setattr(ledger, 'MongoClient', make_client)
+    monkeypatch.setattr(ledger, '_process_ledger', None)
+
+    barrier = threading.Barrier(20)
+    ledgers = []
+
+    def get_ledger():
+        barrier.wait()
+        ledgers.append(ledger.get_process_ledger())
+
+    threads = [threading.Thread(target=get_ledger) for _ in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(clients) == 1
+    assert all(send_ledger is ledgers[0] for send_ledger in ledgers)